@@ -1,9 +1,24 @@
+import hashlib
 import io
-import re
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import weakref
 from typing import Optional
 
 import streamlit as st
-from pypdf import PdfReader, PdfWriter
+from pypdf import PdfWriter
+
+try:
+    import pikepdf
+except ImportError:  # optional: fall back to pypdf
+    pikepdf = None
+
+try:
+    import xxhash
+except ImportError:  # optional: fall back to hashlib
+    xxhash = None
 
 
 def extract_trailing_number(filename: str) -> Optional[int]:
@@ -14,32 +29,118 @@ def extract_trailing_number(filename: str) -> Optional[int]:
     - Prefer last number inside parentheses: `name (8).pdf` -> 8
     - Else, prefer a number immediately before the extension: `name 8.pdf` -> 8
     - Else, return None.
+
+    Any Unicode decimal digit counts, so full-width digits common in Japanese names work too:
+
+    >>> extract_trailing_number("資料１２.pdf")
+    12
+    >>> extract_trailing_number("資料 (１２).pdf")
+    12
+    >>> extract_trailing_number("file (٣).pdf")
+    3
+
+    The last parenthesised number wins even when other parentheses follow it:
+
+    >>> extract_trailing_number("report (2) (copy).pdf")
+    2
+    >>> extract_trailing_number("scan (1) (edited).pdf")
+    1
+    >>> extract_trailing_number("5.x(3)")
+    3
     """
-    # Try last number inside parentheses
-    paren_matches = re.findall(r"\((\d+)\)", filename)
-    if paren_matches:
-        try:
-            return int(paren_matches[-1])
-        except ValueError:
-            pass
+    # Try last number inside parentheses, checking each ")" from the right
+    rp = filename.rfind(")")
+    while rp != -1:
+        lp = filename.rfind("(", 0, rp)
+        if lp == -1:
+            break
+        digits = filename[lp + 1 : rp]
+        if digits.isdecimal():
+            return int(digits)
+        rp = filename.rfind(")", 0, rp)
 
     # Try number just before extension
-    m = re.search(r"(\d+)(?=\.[^.]+$)", filename)
-    if m:
-        try:
-            return int(m.group(1))
-        except ValueError:
-            pass
+    dot = filename.rfind(".")
+    if 0 < dot < len(filename) - 1:
+        i = dot
+        while i > 0 and filename[i - 1].isdecimal():
+            i -= 1
+        if i < dot:
+            return int(filename[i:dot])
 
     # No number found
     return None
 
 
+def content_digest(uploaded_file) -> str:
+    """Return a short content hash of an uploaded file, used to key the merge cache.
+
+    Uses xxHash (XXH3, non-cryptographic but far faster) when installed, else BLAKE2b.
+    """
+    if xxhash is not None:
+        return xxhash.xxh3_64(uploaded_file.getbuffer()).hexdigest()
+    return hashlib.blake2b(uploaded_file.getbuffer(), digest_size=16).hexdigest()
+
+
+def fingerprint_uploads(uploaded_files, cache):
+    """Return `(upload_key, cache)` with one `(name, content hash)` per file, hashing only files not in cache.
+
+    The cache is keyed by Streamlit's per-upload `file_id` (streamlit >= 1.26), which stays the same across reruns;
+    the returned cache holds only the files passed in, so removed uploads don't linger.
+    New files are hashed on a thread pool: both hashlib and xxhash release the GIL while hashing
+    large buffers (xxhash for inputs over 64 KiB), so big uploads hash in parallel on either path.
+    """
+    file_ids = [getattr(f, "file_id", None) for f in uploaded_files]
+    key = [cache.get(file_id) if file_id is not None else None for file_id in file_ids]
+    missing = [pos for pos, fingerprint in enumerate(key) if fingerprint is None]
+    if missing:
+        with ThreadPoolExecutor() as pool:
+            digests = pool.map(content_digest, [uploaded_files[pos] for pos in missing])
+            for pos, digest in zip(missing, digests):
+                key[pos] = (uploaded_files[pos].name, digest)
+
+    fresh = {file_id: fingerprint for file_id, fingerprint in zip(file_ids, key) if file_id is not None}
+    return tuple(key), fresh
+
+
+class MergedOutput:
+    """A merged PDF in its own temp dir, owned by one session (kept in `st.session_state`).
+
+    The dir is removed by `discard()`, or once the owner is garbage collected (e.g. its session
+    ends), or at interpreter exit, whichever comes first.
+    """
+
+    def __init__(self):
+        out_dir = tempfile.mkdtemp(prefix="pdf-binder-")
+        self.path = Path(out_dir) / "merged.pdf"
+        self._finalizer = weakref.finalize(self, shutil.rmtree, out_dir, True)
+
+    def discard(self) -> None:
+        """Remove the output now; safe to call more than once."""
+        self._finalizer()
+
+
+def spool_to_disk(uploaded_file, path):
+    """Copy an upload into path and return the path."""
+    with open(path, "wb") as fh:
+        fh.write(uploaded_file.getbuffer())
+    return path
+
+
 def merge_pdfs_in_order(uploaded_files):
-    """Return merged PDF bytes for uploaded files sorted by extracted trailing number.
+    """Return a `MergedOutput` holding the merged PDF for uploaded files sorted by extracted trailing number.
+
+    The merged PDF is spilled to disk rather than kept in RAM; the caller owns it (see `MergedOutput`).
 
     Tie-breaking: files with equal or missing numbers preserve the original upload order.
+    A single upload is copied through unchanged, without being parsed or rewritten.
     """
+    if len(uploaded_files) == 1:
+        f = uploaded_files[0]
+        output = MergedOutput()
+        spool_to_disk(f, output.path)
+        return output, [(f, extract_trailing_number(f.name), 0)]
+
     # Prepare list with extracted numbers and original index
     prepared = []
     for idx, f in enumerate(uploaded_files):
@@ -48,68 +149,108 @@ def merge_pdfs_in_order(uploaded_files):
 
     # Sort rule change: files WITHOUT a trailing number should come first (preserve upload order among them),
     # then files with numbers sorted by that number, tie-broken by upload order.
-    def sort_key(item):
-        _num = item[1]
-        # For None (no number), use a key that places them before numbered files while preserving upload order
-        if _num is None:
-            return (0, item[2])
-        # Numbered files come after, sorted by number then upload index
-        return (1, _num, item[2])
+    # Extracted numbers are never negative, so -1 stands in for "no number".
+    keys = [(-1 if num is None else num, idx) for _f, num, idx in prepared]
+    # File pickers often hand uploads over already in order; only sort when some pair is out of order
+    if any(keys[i] > keys[i + 1] for i in range(len(keys) - 1)):
+        prepared = [prepared[i] for i in sorted(range(len(keys)), key=keys.__getitem__)]
+
+    # Uploads are already in memory; a BytesIO over getvalue() shares that buffer copy-on-write
+    sources = [(f.name, io.BytesIO(f.getvalue())) for f, _num, _idx in prepared]
+
+    output = MergedOutput()
+    if pikepdf is not None:
+        ok = merge_with_pikepdf(sources, output.path)
+    else:
+        ok = merge_with_pypdf(sources, output.path)
+    if not ok:
+        output.discard()
+        return None
+    return output, prepared
+
+
+def merge_with_pikepdf(sources, out_path) -> bool:
+    """Concatenate `(name, stream)` sources into out_path with qpdf (via pikepdf).
+
+    Pages are moved as C-level object handles, without walking the object graph in Python.
+    """
+    dst = pikepdf.Pdf.new()
+    # Source documents must stay open until dst is saved
+    opened = []
+    try:
+        for name, stream in sources:
+            try:
+                opened.append(pikepdf.Pdf.open(stream))
+            except Exception as e:
+                st.error(f"Error reading {name}: {e}")
+                return False
+            dst.pages.extend(opened[-1].pages)
 
-    prepared.sort(key=sort_key)
+        dst.save(out_path, linearize=False)
+    finally:
+        for pdf in opened:
+            pdf.close()
+        dst.close()
+    return True
 
+
+def merge_with_pypdf(sources, out_path) -> bool:
+    """Concatenate `(name, stream)` sources with pypdf; used when pikepdf isn't installed."""
     writer = PdfWriter()
 
-    for f, num, idx in prepared:
+    # Bookmarks aren't carried into the bound PDF, so don't spend time importing them
+    for name, stream in sources:
         try:
-            # f is an UploadedFile (file-like). We must ensure it's at start
-            f.seek(0)
-            reader = PdfReader(f)
-            for page in reader.pages:
-                writer.add_page(page)
+            writer.append(fileobj=stream, import_outline=False)
         except Exception as e:
-            st.error(f"Error reading {f.name}: {e}")
-            return None
+            st.error(f"Error reading {name}: {e}")
+            return False
+
+    # Collapse fonts/images duplicated across inputs from the same generator (pypdf >= 4.3)
+    try:
+        writer.compress_identical_objects(remove_identicals=True, remove_orphans=False)
+    except AttributeError:
+        pass
 
-    out = io.BytesIO()
-    writer.write(out)
-    out.seek(0)
-    return out.getvalue(), prepared
+    writer.write(out_path)
+    return True
 
 
 # ---- Streamlit UI ----
+# Static page copy
+INTRO_MARKDOWN = """
+アップロードした複数のPDFを、ファイル名の末尾にある数字（例: `document (8).pdf` の `8`）の順番で結合してダウンロードできます。
+
+ルール:
+- 最後の括弧の中の数字を優先して使います: `name (8).pdf` → 8
+- それが無ければ拡張子直前の数字を使います: `name 8.pdf` → 8
+- 数字が見つからないファイルは先頭に置かれます（アップロード順を維持）
+"""
+FOOTER_MARKDOWN = "小さな注意: 大きなPDFを多数アップロードするとメモリを多く使います。必要ならファイルサイズのチェックやストリーム処理を追加してください。"
+
 st.set_page_config(page_title="PDF Binder", layout="centered")
 st.title("PDF Binder — filename-number orderで結合")
 
-st.markdown(
-    """
-    アップロードした複数のPDFを、ファイル名の末尾にある数字（例: `document (8).pdf` の `8`）の順番で結合してダウンロードできます。
+st.markdown(INTRO_MARKDOWN)
 
-    ルール:
-    - 最後の括弧の中の数字を優先して使います: `name (8).pdf` → 8
-    - それが無ければ拡張子直前の数字を使います: `name 8.pdf` → 8
-    - 数字が見つからないファイルは先頭に置かれます（アップロード順を維持）
-    """
+uploaded = st.file_uploader(
+    "PDFファイルをまとめてアップロードしてください", accept_multiple_files=True, type=["pdf"], key="pdf_uploader"
 )
 
-uploaded = st.file_uploader("PDFファイルをまとめてアップロードしてください", accept_multiple_files=True, type=["pdf"])
-
 if uploaded:
     st.subheader("アップロード")
     st.write(f"{len(uploaded)} 個のファイルがアップロードされました。")
 
-    # Prepare a stable key for uploaded set to avoid re-merging unnecessarily
-    try:
-        upload_key = tuple((f.name, f.size) for f in uploaded)
-    except Exception:
-        # Fallback if attribute missing
-        upload_key = tuple((f.name, getattr(f, "size", None)) for f in uploaded)
+    # Prepare a stable key for uploaded set to avoid re-merging unnecessarily.
+    # Names decide the order and the content hash catches same-name/same-size replacements.
+    # Fingerprints are cached per upload so a rerun (e.g. typing a file name) doesn't rehash every file.
+    upload_key, st.session_state["_fp_cache"] = fingerprint_uploads(uploaded, st.session_state.get("_fp_cache", {}))
 
     # Initialize session state entries
     if "merged_key" not in st.session_state:
         st.session_state["merged_key"] = None
-    if "merged_bytes" not in st.session_state:
-        st.session_state["merged_bytes"] = None
+    if "merged_output" not in st.session_state:
+        st.session_state["merged_output"] = None
     if "prepared" not in st.session_state:
         st.session_state["prepared"] = None
     if "output_basename" not in st.session_state:
@@ -117,20 +258,24 @@ if uploaded:
 
     # If uploaded files changed, run merge and cache result
     if st.session_state.get("merged_key") != upload_key:
+        # The previous output is stale either way; drop it from disk
+        if st.session_state.get("merged_output") is not None:
+            st.session_state["merged_output"].discard()
+
         result = merge_pdfs_in_order(uploaded)
         if result is None:
             st.error("PDFの読み込みに失敗しました。ファイルが壊れていないか確認してください。")
-            st.session_state["merged_bytes"] = None
+            st.session_state["merged_output"] = None
             st.session_state["prepared"] = None
             st.session_state["merged_key"] = None
         else:
-            merged_bytes, prepared = result
-            st.session_state["merged_bytes"] = merged_bytes
+            merged_output, prepared = result
+            st.session_state["merged_output"] = merged_output
             st.session_state["prepared"] = prepared
             st.session_state["merged_key"] = upload_key
 
     # If merge succeeded, show order and download UI (auto-merged)
-    if st.session_state.get("merged_bytes"):
+    if st.session_state.get("merged_output") is not None:
         st.success("ダウンロードの準備ができました。")
         col1, col2 = st.columns([3, 1])
 
@@ -141,16 +286,23 @@ if uploaded:
         safe_name = (st.session_state.get("output_basename") or "sample").strip() or "sample"
         out_filename = f"{safe_name}.pdf"
 
+        # Pass a callable so the merged PDF is only read from disk when the button is clicked,
+        # not into memory on every rerun (e.g. each keystroke in the file name box)
         with col2:
             st.download_button(
                 label="ダウンロード",
-                data=st.session_state["merged_bytes"],
+                data=st.session_state["merged_output"].path.read_bytes,
                 file_name=out_filename,
                 mime="application/pdf",
             )
 
 else:
+    # Uploads were cleared: drop the old output now instead of when the session ends
+    if st.session_state.get("merged_output") is not None:
+        st.session_state["merged_output"].discard()
+        st.session_state["merged_output"] = None
+        st.session_state["merged_key"] = None
     st.info("まずは上のアップローダーから複数のPDFを選択してください（Ctrl/Shiftで複数選択可）。")
 
 st.markdown("---")
-st.markdown("小さな注意: 大きなPDFを多数アップロードするとメモリを多く使います。必要ならファイルサイズのチェックやストリーム処理を追加してください。")
+st.markdown(FOOTER_MARKDOWN)